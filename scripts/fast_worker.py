@@ -7,31 +7,48 @@ Fast worker: screen-only relaxation into waiting_pool.
     fast/.done_{k}   # just a 'done' signal so C++ knows it can reuse this slot
 - It does NOT write any RESULT back to C++.
 - It runs a coarse relaxation (screen) and pushes the result into:
-    waiting_pool/<task_id>/{POSCAR, SAVE, meta.json}
+    waiting_pool/b<idx>/<task_id>/{POSCAR, SAVE, meta.json, state.pkl}
+  where task_id = "E=<energy_screen>_<ns>_<slot>_<rand>" and the bucket
+  b<idx> holds energies in [idx*w, (idx+1)*w), w = --pool_bucket_width.
 - The waiting_pool has a soft capacity:
     - If the pool is full, the worker evicts the highest-energy entry
       ONLY if its own energy is lower; otherwise it drops this candidate.
 - Counters:
-    ROOT/counters/fast_count will be incremented for each job handled.
+    fast_count: one shared-memory cell per slot (/dev/shm/paipai_<hash>_fast_count,
+    <hash> = sha1 of the resolved ROOT path), incremented for each job handled
+    and snapshotted to ROOT/counters/fast_count.d/<slot>; the total is the sum
+    (see read_counter). The /dev/shm file lives outside ROOT: its first cell
+    holds the nonce from ROOT/counters/run_id, so a file left by an earlier run
+    at the same path is reset rather than resumed, and paipai removes it on exit.
 """
 print("FAST WORKER START", flush=True)
 
-import os, sys, json, time, tempfile, signal, uuid
+import os, sys, json, time, tempfile, signal, uuid, shutil, pickle, math
+import mmap, hashlib, fcntl
+import struct as _struct  # "struct" is a Structure in main()
 from pathlib import Path
 from typing import Optional
 from pymatgen.core import Structure
 from pymatgen.io.vasp import Poscar
 from materialsframework.calculators import GraceCalculator
+try:
+    from inotify_simple import INotify, flags as iflags
+except ImportError:  # optional: poll instead
+    INotify = None
 
 # ---------- atomic helpers ----------
-def atomic_write_text(path: Path, text: str) -> None:
+# The tempfile + os.replace() is what keeps readers from seeing torn files.
+# fsync only adds power-loss durability, which worker outputs do not need
+# (the master re-queues lost work), so it is opt-in.
+def atomic_write_text(path: Path, text: str, fsync: bool = False) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
     fd, tmp = tempfile.mkstemp(prefix=".tmp_", dir=str(path.parent))
     try:
         with os.fdopen(fd, "w") as f:
             f.write(text)
-            f.flush()
-            os.fsync(f.fileno())
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
         os.replace(tmp, str(path))
     finally:
         try:
@@ -39,112 +56,269 @@ def atomic_write_text(path: Path, text: str) -> None:
         except FileNotFoundError:
             pass
 
-def atomic_write_json(path: Path, obj) -> None:
-    atomic_write_text(path, json.dumps(obj, ensure_ascii=False, indent=2) + "\n")
+# ---------- plain writers ----------
+# For files inside a private '.tmp_' staging directory: renaming the
+# directory publishes all of them at once, so no per-file tempfile/rename.
+def write_text_plain(path: Path, text: str) -> None:
+    with open(path, "w") as f:
+        f.write(text)
 
-def atomic_write_poscar(structure, path: Path) -> None:
-    path.parent.mkdir(parents=True, exist_ok=True)
-    fd, tmp = tempfile.mkstemp(prefix=".tmp_", dir=str(path.parent))
-    os.close(fd)
-    Poscar(structure).write_file(tmp)
-    with open(tmp, "rb") as rf:
-        os.fsync(rf.fileno())
-    os.replace(tmp, str(path))
-    try:
-        os.remove(tmp)
-    except FileNotFoundError:
-        pass
+def write_json_plain(path: Path, obj) -> None:
+    write_text_plain(path, json.dumps(obj, ensure_ascii=False, indent=2) + "\n")
 
-def atomic_copy(src: Path, dst: Path) -> None:
-    """Copy a small file atomically (read all, then replace)."""
-    if not src.exists():
-        return
-    dst.parent.mkdir(parents=True, exist_ok=True)
-    data = src.read_bytes()
-    fd, tmp = tempfile.mkstemp(prefix=".tmp_", dir=str(dst.parent))
-    try:
-        with os.fdopen(fd, "wb") as f:
-            f.write(data)
-            f.flush()
-            os.fsync(f.fileno())
-        os.replace(tmp, str(dst))
-    finally:
-        try:
-            os.remove(tmp)
-        except FileNotFoundError:
-            pass
+def write_poscar_plain(structure, path: Path) -> None:
+    Poscar(structure).write_file(str(path))
 
-def atomic_increment_counter(root: Path, name: str, retries: int = 50, sleep_s: float = 0.01):
-    """Naive lock-based atomic integer counter."""
-    cdir = root / "counters"
-    cdir.mkdir(parents=True, exist_ok=True)
-    cpath = cdir / name
-    lock = cdir / (name + ".lock")
-    for _ in range(retries):
+# ---------- counters ----------
+# Striped counters: one uint64 cell per worker slot in a shared-memory file,
+# so an increment is a single store with no lock (each cell has one writer).
+# Cell 0 holds the run nonce (see counter_run_id), slot i lives in cell i+1.
+# counters/<name>.d/<slot> keeps an on-disk snapshot of each cell, written at
+# most every COUNTER_SNAPSHOT_S seconds, for recovery after a reboot.
+SHM_DIR = "/dev/shm"
+COUNTER_SNAPSHOT_S = 5.0
+
+def counter_shm_path(root: Path, name: str) -> str:
+    tag = hashlib.sha1(str(root).encode()).hexdigest()[:12]
+    return os.path.join(SHM_DIR, f"paipai_{tag}_{name}")
+
+def counter_run_id(root: Path, create: bool = True) -> int:
+    """
+    Nonce of this run directory, kept in ROOT/counters/run_id (0 if absent).
+    Shared-memory cells stamped with another nonce are left over from an
+    earlier run at the same path (e.g. ROOT was deleted) and are ignored.
+    """
+    path = root / "counters" / "run_id"
+    if create and not path.exists():
+        fd, tmp = tempfile.mkstemp(prefix=".tmp_", dir=str(path.parent))
+        with os.fdopen(fd, "w") as f:
+            f.write(f"{int.from_bytes(os.urandom(8), 'little') | 1}\n")
         try:
-            fd = os.open(str(lock), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
-            os.close(fd)
+            os.link(tmp, path)  # first worker wins, the others read its nonce
         except FileExistsError:
-            time.sleep(sleep_s)
-            continue
-        try:
-            old = 0
-            if cpath.exists():
-                try:
-                    old = int(cpath.read_text().strip() or "0")
-                except Exception:
-                    old = 0
-            atomic_write_text(cpath, f"{old+1}\n")
+            pass
         finally:
+            os.remove(tmp)
+    try:
+        return int(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+def open_counter(root: Path, name: str, slot: int) -> dict:
+    """
+    Open this worker's cell of counter `name`; returns a handle for
+    bump_counter(). Falls back to disk snapshots only if shared memory
+    is unavailable.
+    """
+    snap = root / "counters" / (name + ".d") / str(slot)
+    snap.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        value = int(snap.read_text().strip() or "0")
+    except (FileNotFoundError, ValueError):
+        value = 0
+    mm = None
+    if os.path.isdir(SHM_DIR):
+        run_id = counter_run_id(root)
+        size = (slot + 2) * 8  # cell 0 is the run nonce
+        try:
+            fd = os.open(counter_shm_path(root, name), os.O_RDWR | os.O_CREAT, 0o644)
             try:
-                lock.unlink()
-            except FileNotFoundError:
-                pass
-        return
+                fcntl.flock(fd, fcntl.LOCK_EX)  # one worker at a time resets
+                head = os.pread(fd, 8, 0)
+                if len(head) == 8 and _struct.unpack("<Q", head)[0] != run_id:
+                    os.ftruncate(fd, 0)  # stale cells from an earlier run
+                os.posix_fallocate(fd, 0, size)  # grows, never shrinks
+                mm = mmap.mmap(fd, size)
+                _struct.pack_into("<Q", mm, 0, run_id)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)  # mmap keeps a dup of fd
+                os.close(fd)
+            value = max(value, _struct.unpack_from("<Q", mm, (slot + 1) * 8)[0])
+        except OSError:
+            mm = None
+    return {"slot": slot, "value": value, "mm": mm, "snap": snap, "snap_t": 0.0}
+
+def bump_counter(counter: dict) -> None:
+    counter["value"] += 1
+    if counter["mm"] is not None:
+        _struct.pack_into("<Q", counter["mm"], (counter["slot"] + 1) * 8, counter["value"])
+    now = time.monotonic()
+    if counter["mm"] is None or now - counter["snap_t"] >= COUNTER_SNAPSHOT_S:
+        flush_counter(counter)
+        counter["snap_t"] = now
+
+def flush_counter(counter: dict) -> None:
+    """Write the on-disk snapshot of this worker's cell."""
+    atomic_write_text(counter["snap"], f"{counter['value']}\n")
+
+def read_counter(root: Path, name: str) -> int:
+    """Sum all cells: from shared memory if current, else the disk snapshots."""
+    try:
+        with open(counter_shm_path(root, name), "rb") as f:
+            data = f.read()
+        n = len(data) // 8
+        cells = _struct.unpack_from(f"<{n}Q", data)
+        if n and cells[0] == counter_run_id(root, create=False):
+            return sum(cells[1:])
+    except FileNotFoundError:
+        pass
+    total = 0
+    cdir = root / "counters" / (name + ".d")
+    if not cdir.exists():
+        return total
+    for p in cdir.iterdir():
+        try:
+            total += int(p.read_text().strip() or "0")
+        except (OSError, ValueError):
+            pass
+    return total
 
 # ---------- waiting_pool helpers ----------
-def list_pool_with_energy(pool: Path):
-    """Return list of (energy_screen, path) for tasks in waiting_pool."""
+def energy_from_task_id(task_id: str) -> float:
+    """Parse energy_screen from a task_id 'E=<energy>_...' (1e99 if malformed)."""
+    if not task_id.startswith("E="):
+        return 1e99
+    try:
+        return float(task_id[2:task_id.index("_")])
+    except ValueError:
+        return 1e99
+
+def positive_float(text: str) -> float:
+    """argparse type for a finite float > 0."""
+    x = float(text)
+    if not (math.isfinite(x) and x > 0):
+        raise ValueError(text)
+    return x
+
+def pool_bucket(E: float, width: float) -> str:
+    """Name of the waiting_pool bucket holding energies in [i*width, (i+1)*width)."""
+    return f"b{math.floor(E / width):+d}"
+
+def list_buckets(pool: Path):
+    """Return (index, path_str) of waiting_pool buckets, lowest energy first."""
     out = []
-    if not pool.exists():
-        return out
-    for d in pool.iterdir():
-        if not d.is_dir() or d.name.startswith(".tmp_"):
-            continue
-        meta = d / "meta.json"
-        try:
-            E = float(json.loads(meta.read_text())["energy_screen"])
-        except Exception:
-            E = 1e99
-        out.append((E, d))
+    try:
+        with os.scandir(pool) as it:
+            for e in it:
+                if not e.name.startswith("b") or not e.is_dir(follow_symlinks=False):
+                    continue
+                try:
+                    out.append((int(e.name[1:]), e.path))
+                except ValueError:
+                    continue
+    except OSError:
+        pass  # missing or unreadable pool: scan what we have, retry next round
+    out.sort()
     return out
 
+def stage_in_bucket(bucket: Path, task_id: str, retries: int = 5) -> Path:
+    """
+    Create the private staging directory bucket/.tmp_<task_id>. Slow
+    workers remove buckets left empty for a while, so an old bucket may
+    vanish while we create it or before the second mkdir; retry then.
+    Once the staging directory exists the bucket cannot be removed.
+    """
+    tmpd = bucket / (".tmp_" + task_id)
+    for _ in range(retries):
+        try:
+            bucket.mkdir(parents=True, exist_ok=True)
+            tmpd.mkdir()
+            return tmpd
+        except (FileNotFoundError, FileExistsError):
+            continue  # bucket removed between the calls
+    raise RuntimeError(f"could not stage {task_id} in {bucket.name}")
+
+# Evicted entries, already renamed out of sight; deleted after the slot
+# has been handed back to the master (see flush_pending_removals).
+_pending_removals = []
+
+def flush_pending_removals() -> None:
+    while _pending_removals:
+        shutil.rmtree(_pending_removals.pop(), ignore_errors=True)
+
+def sweep_stale_evictions(pool: Path) -> None:
+    """
+    Delete '.tmp_evict_*' left by a worker killed before its flush. Entries
+    still pending in a live worker are hidden already, so removing them
+    early is harmless (its own rmtree then finds nothing).
+    """
+    try:
+        names = os.listdir(pool)
+    except OSError:
+        return
+    for name in names:
+        if name.startswith(".tmp_evict_"):
+            shutil.rmtree(os.path.join(pool, name), ignore_errors=True)
+
 def maybe_evict_for_capacity(pool: Path, capacity: int, my_E: float) -> bool:
     """
     If pool size >= capacity, evict the highest-energy task IFF my_E < E_max.
     Returns True if we can insert, False if we should drop this candidate.
+    Only the highest non-empty bucket is searched for the victim; the
+    others are just counted.
     """
-    cands = list_pool_with_energy(pool)
-    if len(cands) < capacity:
+    n = 0
+    top = None
+    for _, bdir in list_buckets(pool):
+        try:
+            names = [x for x in os.listdir(bdir) if not x.startswith(".tmp_")]
+        except FileNotFoundError:
+            continue
+        n += len(names)
+        if names:
+            top = (bdir, names)
+    if n < capacity:
         return True
-    cands.sort(key=lambda x: x[0])  # ascending
-    E_max, p_max = cands[-1]
+    if top is None:
+        return False
+    bdir, names = top
+    E_max, name = max((energy_from_task_id(x), x) for x in names)
     if my_E < E_max:
+        # one rename hides the victim from every scan; delete it later
+        graveyard = os.path.join(pool, ".tmp_evict_" + uuid.uuid4().hex[:8])
         try:
-            for p in p_max.iterdir():
-                try:
-                    p.unlink()
-                except IsADirectoryError:
-                    pass
-            p_max.rmdir()
-            return True
-        except Exception:
-            # If removal fails (race), re-check size once
-            cands2 = list_pool_with_energy(pool)
-            return len(cands2) < capacity
+            os.rename(os.path.join(bdir, name), graveyard)
+        except FileNotFoundError:
+            # lost the race: a slow worker claimed it, so the pool shrank anyway
+            return n - 1 < capacity
+        except OSError:
+            return False  # next candidate re-evaluates from a fresh scan
+        _pending_removals.append(graveyard)
+        return True
     else:
         return False
 
+# ---------- event waiting ----------
+# Idle slices are bounded so SIGTERM/SIGINT is still noticed promptly.
+WAIT_SLICE_S = 0.5
+# Safety re-check of .go_{k} while waiting on inotify (e.g. queue overflow).
+GO_RECHECK_S = 5.0
+
+def open_dir_watch(path: Path):
+    """
+    inotify watch on `path` for entries created or renamed into it.
+    Returns None (callers fall back to polling) if inotify is unavailable.
+    """
+    if INotify is None:
+        return None
+    try:
+        watch = INotify()
+        watch.add_watch(str(path), iflags.CREATE | iflags.MOVED_TO)
+        return watch
+    except OSError:
+        return None
+
+def wait_for_event(watch, timeout_s: float, name: Optional[str] = None) -> bool:
+    """
+    Block until `watch` has events or timeout_s passes. Returns True if any
+    event concerns a published entry (staging '.tmp_' names are ignored),
+    or, with `name`, that exact entry.
+    """
+    events = watch.read(timeout=int(timeout_s * 1000))
+    if name is not None:
+        return any(ev.name == name for ev in events)
+    return any(not ev.name.startswith(".tmp_") for ev in events)
+
 print("FAST WORKER PYTHON MODULE LOADED", flush=True)
 
 # ---------- main ----------
@@ -159,6 +333,8 @@ def main():
     ap.add_argument("--fmax_screen", type=float, default=0.10)
     ap.add_argument("--max_steps_screen", type=int, default=30)
     ap.add_argument("--pool_cap", type=int, default=128, help="waiting_pool capacity")
+    ap.add_argument("--pool_bucket_width", type=positive_float, default=0.1,
+                    help="energy width (eV) of one waiting_pool bucket")
     args = ap.parse_args()
 
     k = args.slot
@@ -171,6 +347,7 @@ def main():
     savef  = FAST / f"SAVE{k}"
     gof    = FAST / f".go_{k}"
     donef  = FAST / f".done_{k}"
+    gof_s  = str(gof)  # polled as a plain string, no Path overhead
 
     calc = GraceCalculator(
         model=args.model,
@@ -181,18 +358,31 @@ def main():
     )
     sys.stderr.write(f"[fast {k}] initialized @ {ROOT}\n")
 
+    counter = open_counter(ROOT, "fast_count", k)
+    sweep_stale_evictions(POOL)
+
+    FAST.mkdir(parents=True, exist_ok=True)
+    go_watch = open_dir_watch(FAST)
+
     stop = {"flag": False}
     def _sigterm(*_): stop["flag"] = True
     signal.signal(signal.SIGINT, _sigterm)
     signal.signal(signal.SIGTERM, _sigterm)
 
     while not stop["flag"]:
-        if not gof.exists():
-            time.sleep(0.05)
+        if not os.path.exists(gof_s):
+            if go_watch is None:
+                time.sleep(0.05)
+                continue
+            # other slots' handshakes are skipped without touching the disk
+            deadline = time.monotonic() + GO_RECHECK_S
+            while not stop["flag"] and time.monotonic() < deadline:
+                if wait_for_event(go_watch, WAIT_SLICE_S, gof.name):
+                    break
             continue
 
         try:
-            atomic_increment_counter(ROOT, "fast_count")
+            bump_counter(counter)
 
             # read POSCAR (retry a short window)
             struct = None
@@ -207,40 +397,55 @@ def main():
 
             # run coarse relaxation
             t0 = time.time()
-            calc.fmax = args.fmax_screen
-            calc.max_steps = args.max_steps_screen
             res = calc.relax(struct)
             E_screen = float(res["energy"])
             struct_screen = res["final_structure"]
             elapsed = round(time.time() - t0, 3)
 
             # capacity check for waiting_pool
-            ok = maybe_evict_for_capacity(POOL, args.pool_cap, E_screen)
-            if not ok:
+            if not math.isfinite(E_screen):
+                # cannot be ranked or bucketed; never worth refining
+                sys.stderr.write(f"[fast {k}] drop candidate with non-finite E={E_screen}.\n")
+            elif not maybe_evict_for_capacity(POOL, args.pool_cap, E_screen):
                 # drop this candidate silently; pool is full with better structures
                 sys.stderr.write(
                     f"[fast {k}] drop candidate E={E_screen:.6f} due to pool full.\n"
                 )
             else:
-                # insert into waiting_pool/<task_id> atomically
-                task_id = f"{int(time.time() * 1e9)}_{k}_{uuid.uuid4().hex[:8]}"
-                tmpd  = POOL / (".tmp_" + task_id)
-                final = POOL / task_id
-                tmpd.mkdir(parents=True, exist_ok=True)
-                atomic_write_poscar(struct_screen, tmpd / "POSCAR")
-                if savef.exists():
-                    atomic_copy(savef, tmpd / "SAVE")
-                meta = {
-                    "task_id": task_id,
-                    "source_slot": k,
-                    "energy_screen": E_screen,
-                    "fmax_screen": args.fmax_screen,
-                    "max_steps_screen": args.max_steps_screen,
-                    "elapsed_screen_s": elapsed,
-                    "stamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-                }
-                atomic_write_json(tmpd / "meta.json", meta)
-                os.rename(tmpd, final)
+                # stage in the private tmpd, then publish with one rename
+                # energy goes into the name so pool scans never open meta.json
+                task_id = (
+                    f"E={E_screen:+.9f}_{int(time.time() * 1e9)}_{k}_{uuid.uuid4().hex[:8]}"
+                )
+                bucket = POOL / pool_bucket(E_screen, args.pool_bucket_width)
+                tmpd   = stage_in_bucket(bucket, task_id)
+                try:
+                    write_poscar_plain(struct_screen, tmpd / "POSCAR")
+                    # pickled Structure saves the slow worker a POSCAR parse
+                    with open(tmpd / "state.pkl", "wb") as f:
+                        pickle.dump(
+                            {"structure": struct_screen, "energy_screen": E_screen},
+                            f, protocol=pickle.HIGHEST_PROTOCOL,
+                        )
+                    # the master rewrites fast/SAVE{k} in place for the next
+                    # candidate, so this one is copied rather than hard-linked
+                    if savef.exists():
+                        shutil.copyfile(savef, tmpd / "SAVE")
+                    meta = {
+                        "task_id": task_id,
+                        "source_slot": k,
+                        "energy_screen": E_screen,
+                        "fmax_screen": args.fmax_screen,
+                        "max_steps_screen": args.max_steps_screen,
+                        "elapsed_screen_s": elapsed,
+                        "stamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+                    }
+                    write_json_plain(tmpd / "meta.json", meta)
+                    os.rename(tmpd, bucket / task_id)
+                except Exception:
+                    # an unpublished tmpd would keep its bucket from ever being removed
+                    shutil.rmtree(tmpd, ignore_errors=True)
+                    raise
 
         except Exception as e:
             sys.stderr.write(f"[fast {k}] ERROR: {e}\n")
@@ -252,7 +457,9 @@ def main():
                 gof.unlink()
             except FileNotFoundError:
                 pass
+            flush_pending_removals()
 
+    flush_counter(counter)
     sys.stderr.write(f"[fast {k}] bye\n")
 
 if __name__ == "__main__":
@@ -2,11 +2,14 @@
 """
 Slow worker: refine-only, consuming jobs from waiting_pool.
 - Input pool:
-    waiting_pool/<task_id>/{POSCAR, SAVE, meta.json}
+    waiting_pool/b<idx>/<task_id>/{POSCAR, SAVE, meta.json, state.pkl}
+  with tasks bucketed by energy_screen (see fast_worker.py).
 - Each slow worker:
-    * Scans waiting_pool, sorts candidates by 'energy_screen' ascending,
+    * Walks the buckets in ascending energy order and, within the first
+      non-empty one, sorts candidates by 'energy_screen' ascending
+      (encoded in the task name as 'E=<energy>_...'),
     * Atomically claims a job via rename:
-          waiting_pool/<task_id> -> waiting_work/<task_id>
+          waiting_pool/b<idx>/<task_id> -> waiting_work/<task_id>
     * Runs a stricter relaxation (refinement),
     * Writes result into:
           refine_outbox/<task_id>/{CONTCAR, SAVE, energy, meta.json}
@@ -14,25 +17,37 @@ Slow worker: refine-only, consuming jobs from waiting_pool.
     * Drops a lightweight report for the master into:
           reports/<task_id>.json
     * Removes the directory in waiting_work/<task_id> after finishing.
+    The output step runs on a background writer thread, so the next job is
+    claimed and relaxed while the previous one is being written.
 - Counters:
-    ROOT/counters/slow_count incremented for each claimed job.
+    slow_count: one shared-memory cell per --slot, incremented for each
+    claimed job and snapshotted to ROOT/counters/slow_count.d/<slot>
+    (see fast_worker.py for the layout and the /dev/shm file it uses).
 """
 
-import os, sys, json, time, tempfile, signal
+import os, sys, json, time, tempfile, signal, shutil, pickle, queue, threading
+import mmap, hashlib, fcntl
+import struct as _struct  # "struct" is a Structure in main()
 from pathlib import Path
 from pymatgen.core import Structure
 from pymatgen.io.vasp import Poscar
 from materialsframework.calculators import GraceCalculator
+try:
+    from inotify_simple import INotify, flags as iflags
+except ImportError:  # optional: poll instead
+    INotify = None
 
 # ---------- atomic helpers ----------
-def atomic_write_text(path: Path, text: str) -> None:
+# fsync is opt-in: os.replace() alone keeps readers from seeing torn files.
+def atomic_write_text(path: Path, text: str, fsync: bool = False) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
     fd, tmp = tempfile.mkstemp(prefix=".tmp_", dir=str(path.parent))
     try:
         with os.fdopen(fd, "w") as f:
             f.write(text)
-            f.flush()
-            os.fsync(f.fileno())
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
         os.replace(tmp, str(path))
     finally:
         try:
@@ -40,95 +55,312 @@ def atomic_write_text(path: Path, text: str) -> None:
         except FileNotFoundError:
             pass
 
-def atomic_write_json(path: Path, obj) -> None:
-    atomic_write_text(path, json.dumps(obj, ensure_ascii=False, indent=2) + "\n")
+def atomic_write_json(path: Path, obj, fsync: bool = False) -> None:
+    atomic_write_text(path, json.dumps(obj, ensure_ascii=False, indent=2) + "\n", fsync=fsync)
 
-def atomic_write_poscar(structure, path: Path) -> None:
-    path.parent.mkdir(parents=True, exist_ok=True)
-    fd, tmp = tempfile.mkstemp(prefix=".tmp_", dir=str(path.parent))
-    os.close(fd)
-    Poscar(structure).write_file(tmp)
-    with open(tmp, "rb") as rf:
-        os.fsync(rf.fileno())
-    os.replace(tmp, str(path))
-    try:
-        os.remove(tmp)
-    except FileNotFoundError:
-        pass
+# ---------- plain writers ----------
+# For files inside a private '.tmp_' staging directory: renaming the
+# directory publishes all of them at once, so no per-file tempfile/rename.
+def write_text_plain(path: Path, text: str) -> None:
+    with open(path, "w") as f:
+        f.write(text)
+
+def write_json_plain(path: Path, obj) -> None:
+    write_text_plain(path, json.dumps(obj, ensure_ascii=False, indent=2) + "\n")
 
-def atomic_copy(src: Path, dst: Path) -> None:
-    if not src.exists():
-        return
-    dst.parent.mkdir(parents=True, exist_ok=True)
-    data = src.read_bytes()
-    fd, tmp = tempfile.mkstemp(prefix=".tmp_", dir=str(dst.parent))
+def write_poscar_plain(structure, path: Path) -> None:
+    Poscar(structure).write_file(str(path))
+
+def link_or_copy(src: Path, dst: Path) -> None:
+    """
+    Hard-link src to dst (no bytes copied); fall back to a plain copy when a
+    link is not possible. Only for sources nobody rewrites in place.
+    """
     try:
-        with os.fdopen(fd, "wb") as f:
-            f.write(data)
-            f.flush()
-            os.fsync(f.fileno())
-        os.replace(tmp, str(dst))
-    finally:
-        try:
-            os.remove(tmp)
-        except FileNotFoundError:
-            pass
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+# ---------- counters ----------
+# Shared-memory striped counters, same layout as in fast_worker.py.
+SHM_DIR = "/dev/shm"
+COUNTER_SNAPSHOT_S = 5.0
+
+def counter_shm_path(root: Path, name: str) -> str:
+    tag = hashlib.sha1(str(root).encode()).hexdigest()[:12]
+    return os.path.join(SHM_DIR, f"paipai_{tag}_{name}")
 
-def atomic_increment_counter(root: Path, name: str, retries: int = 50, sleep_s: float = 0.01):
-    cdir = root / "counters"
-    cdir.mkdir(parents=True, exist_ok=True)
-    cpath = cdir / name
-    lock = cdir / (name + ".lock")
-    for _ in range(retries):
+def counter_run_id(root: Path, create: bool = True) -> int:
+    """
+    Nonce of this run directory, kept in ROOT/counters/run_id (0 if absent).
+    Shared-memory cells stamped with another nonce are left over from an
+    earlier run at the same path (e.g. ROOT was deleted) and are ignored.
+    """
+    path = root / "counters" / "run_id"
+    if create and not path.exists():
+        fd, tmp = tempfile.mkstemp(prefix=".tmp_", dir=str(path.parent))
+        with os.fdopen(fd, "w") as f:
+            f.write(f"{int.from_bytes(os.urandom(8), 'little') | 1}\n")
         try:
-            fd = os.open(str(lock), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
-            os.close(fd)
+            os.link(tmp, path)  # first worker wins, the others read its nonce
         except FileExistsError:
-            time.sleep(sleep_s)
-            continue
-        try:
-            old = 0
-            if cpath.exists():
-                try:
-                    old = int(cpath.read_text().strip() or "0")
-                except Exception:
-                    old = 0
-            atomic_write_text(cpath, f"{old+1}\n")
+            pass
         finally:
+            os.remove(tmp)
+    try:
+        return int(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+def open_counter(root: Path, name: str, slot: int) -> dict:
+    """
+    Open this worker's cell of counter `name`; returns a handle for
+    bump_counter(). Falls back to disk snapshots only if shared memory
+    is unavailable.
+    """
+    snap = root / "counters" / (name + ".d") / str(slot)
+    snap.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        value = int(snap.read_text().strip() or "0")
+    except (FileNotFoundError, ValueError):
+        value = 0
+    mm = None
+    if os.path.isdir(SHM_DIR):
+        run_id = counter_run_id(root)
+        size = (slot + 2) * 8  # cell 0 is the run nonce
+        try:
+            fd = os.open(counter_shm_path(root, name), os.O_RDWR | os.O_CREAT, 0o644)
             try:
-                lock.unlink()
-            except FileNotFoundError:
-                pass
-        return
+                fcntl.flock(fd, fcntl.LOCK_EX)  # one worker at a time resets
+                head = os.pread(fd, 8, 0)
+                if len(head) == 8 and _struct.unpack("<Q", head)[0] != run_id:
+                    os.ftruncate(fd, 0)  # stale cells from an earlier run
+                os.posix_fallocate(fd, 0, size)  # grows, never shrinks
+                mm = mmap.mmap(fd, size)
+                _struct.pack_into("<Q", mm, 0, run_id)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)  # mmap keeps a dup of fd
+                os.close(fd)
+            value = max(value, _struct.unpack_from("<Q", mm, (slot + 1) * 8)[0])
+        except OSError:
+            mm = None
+    return {"slot": slot, "value": value, "mm": mm, "snap": snap, "snap_t": 0.0}
+
+def bump_counter(counter: dict) -> None:
+    counter["value"] += 1
+    if counter["mm"] is not None:
+        _struct.pack_into("<Q", counter["mm"], (counter["slot"] + 1) * 8, counter["value"])
+    now = time.monotonic()
+    if counter["mm"] is None or now - counter["snap_t"] >= COUNTER_SNAPSHOT_S:
+        flush_counter(counter)
+        counter["snap_t"] = now
+
+def flush_counter(counter: dict) -> None:
+    """Write the on-disk snapshot of this worker's cell."""
+    atomic_write_text(counter["snap"], f"{counter['value']}\n")
+
+def read_counter(root: Path, name: str) -> int:
+    """Sum all cells: from shared memory if current, else the disk snapshots."""
+    try:
+        with open(counter_shm_path(root, name), "rb") as f:
+            data = f.read()
+        n = len(data) // 8
+        cells = _struct.unpack_from(f"<{n}Q", data)
+        if n and cells[0] == counter_run_id(root, create=False):
+            return sum(cells[1:])
+    except FileNotFoundError:
+        pass
+    total = 0
+    cdir = root / "counters" / (name + ".d")
+    if not cdir.exists():
+        return total
+    for p in cdir.iterdir():
+        try:
+            total += int(p.read_text().strip() or "0")
+        except (OSError, ValueError):
+            pass
+    return total
 
 # ---------- waiting_pool selection ----------
-def list_pool_sorted_by_energy(pool: Path):
-    """Return list of task directories sorted by energy_screen ascending."""
-    cands = []
-    if pool.exists():
-        for d in pool.iterdir():
-            if not d.is_dir() or d.name.startswith(".tmp_"):
-                continue
+def energy_from_task_id(task_id: str) -> float:
+    """Parse energy_screen from a task_id 'E=<energy>_...' (1e99 if malformed)."""
+    if not task_id.startswith("E="):
+        return 1e99
+    try:
+        return float(task_id[2:task_id.index("_")])
+    except ValueError:
+        return 1e99
+
+def list_buckets(pool: Path):
+    """Return (index, path_str) of waiting_pool buckets, lowest energy first."""
+    out = []
+    try:
+        with os.scandir(pool) as it:
+            for e in it:
+                if not e.name.startswith("b") or not e.is_dir(follow_symlinks=False):
+                    continue
+                try:
+                    out.append((int(e.name[1:]), e.path))
+                except ValueError:
+                    continue
+    except OSError:
+        pass  # missing or unreadable pool: scan what we have, retry next round
+    out.sort()
+    return out
+
+EMPTY_BUCKET_GRACE_S = 30.0
+
+def iter_pool_by_energy(pool: Path, watch=None):
+    """
+    Yield (bucket_dir, task_name) in ascending energy_screen order.
+    Buckets are listed lazily, lowest first, so a claim that succeeds in
+    the first non-empty bucket never touches the others. Buckets left
+    empty for EMPTY_BUCKET_GRACE_S are removed on the way (a fresh one is
+    about to receive a task). With `watch`, each bucket is added to the
+    inotify watch before it is listed, so no insert can be missed.
+    """
+    for _, bdir in list_buckets(pool):
+        if watch is not None:
             try:
-                meta = json.loads((d / "meta.json").read_text())
-                E = float(meta.get("energy_screen", 1e99))
-            except Exception:
-                E = 1e99
-            cands.append((E, d))
-    cands.sort(key=lambda x: x[0])
-    return [d for _, d in cands]
+                add_dir_watch(watch, bdir)
+            except OSError:
+                continue  # bucket removed meanwhile
+        cands = []
+        try:
+            with os.scandir(bdir) as it:
+                for e in it:
+                    if e.name.startswith(".tmp_") or not e.is_dir(follow_symlinks=False):
+                        continue
+                    cands.append((energy_from_task_id(e.name), e.name))
+        except OSError:
+            continue  # bucket removed meanwhile, or unreadable (EACCES/EIO/ESTALE)
+        if not cands:
+            try:
+                if time.time() - os.stat(bdir).st_mtime > EMPTY_BUCKET_GRACE_S:
+                    os.rmdir(bdir)
+            except OSError:
+                pass  # not empty: a fast worker is staging into it
+            continue
+        cands.sort()
+        for _, name in cands:
+            yield bdir, name
+
+def load_task_structure(task_dir: Path):
+    """Structure of a claimed task: from state.pkl if present, else POSCAR."""
+    try:
+        with open(task_dir / "state.pkl", "rb") as f:
+            return pickle.load(f)["structure"]
+    except Exception:
+        return Structure.from_file(str(task_dir / "POSCAR"))
+
+# ---------- output writer ----------
+def write_error_report(rept: Path, task_id: str, worker_id: str, err: Exception) -> None:
+    atomic_write_json(rept / f"{task_id}.json", {
+        "task_id": task_id,
+        "status": "error",
+        "error": str(err),
+        "worker_id": worker_id,
+        "stamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+    })
+
+def publish_refined(job: dict) -> None:
+    """
+    Write refine_outbox/<task_id> and the master report for one refined job,
+    then drop its waiting_work directory.
+    """
+    picked, task_id = job["picked"], job["task_id"]
+    tmpd  = job["out"] / (".tmp_" + task_id)
+    final = job["out"] / task_id
+    try:
+        tmpd.mkdir(parents=True, exist_ok=True)
+
+        # tmpd is private until the rename below, so plain writes suffice
+        write_poscar_plain(job["struct_final"], tmpd / "CONTCAR")
+        write_text_plain(tmpd / "energy", f"{job['energy_final']:.12f}\n")
+        write_json_plain(tmpd / "meta.json", job["meta_out"])
+
+        # pass-through SAVE if present
+        save_in = picked / "SAVE"
+        if save_in.exists():
+            link_or_copy(save_in, tmpd / "SAVE")
+
+        os.rename(tmpd, final)
+
+        # lightweight report for C++ master
+        atomic_write_json(job["rept"] / f"{task_id}.json", job["report"])
+    except Exception as e:
+        write_error_report(job["rept"], task_id, job["meta_out"]["worker_id"], e)
+    finally:
+        shutil.rmtree(picked, ignore_errors=True)
+
+def output_writer(jobs: queue.Queue) -> None:
+    """Writer thread: publish queued jobs until a None sentinel arrives."""
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        try:
+            publish_refined(job)
+        except Exception as e:
+            # e.g. reports/ unwritable: log it, the writer must keep running
+            sys.stderr.write(
+                f"[{job['meta_out']['worker_id']}] failed to publish {job['task_id']}: {e}\n"
+            )
+
+def hand_off(jobs: queue.Queue, writer: threading.Thread, job) -> None:
+    """Queue `job` for the writer thread; raise instead of blocking if it died."""
+    while True:
+        try:
+            jobs.put(job, timeout=WAIT_SLICE_S)
+            return
+        except queue.Full:
+            if not writer.is_alive():
+                raise RuntimeError("output writer thread is not running")
+
+# ---------- event waiting ----------
+WAIT_SLICE_S = 0.5
+
+def open_dir_watch(path: Path):
+    """
+    inotify watch on `path` for entries created or renamed into it.
+    Returns None (callers fall back to polling) if inotify is unavailable.
+    """
+    if INotify is None:
+        return None
+    try:
+        watch = INotify()
+        add_dir_watch(watch, path)
+        return watch
+    except OSError:
+        return None
+
+def add_dir_watch(watch, path) -> None:
+    watch.add_watch(str(path), iflags.CREATE | iflags.MOVED_TO)
+
+def wait_for_event(watch, timeout_s: float) -> bool:
+    """
+    Block until `watch` has events or timeout_s passes. Returns True if any
+    event concerns a published entry (staging '.tmp_' names are ignored).
+    """
+    events = watch.read(timeout=int(timeout_s * 1000))
+    return any(not ev.name.startswith(".tmp_") for ev in events)
 
 # ---------- main ----------
 def main():
     import argparse
     ap = argparse.ArgumentParser(description="Slow worker (refine-only from waiting_pool)")
     ap.add_argument("--worker-id", type=str, default="slow-00")
+    ap.add_argument("--slot", type=int, required=True,
+                    help="counter slot, unique among slow workers")
     ap.add_argument("--root", type=str, default=".")
     ap.add_argument("--model", type=str, default="GRACE-2L-OMAT")
     ap.add_argument("--device", type=str, default="cpu", choices=["cpu", "cuda"])
     ap.add_argument("--fmax_refine", type=float, default=0.01)
     ap.add_argument("--max_steps_refine", type=int, default=400)
-    ap.add_argument("--sleep_idle", type=float, default=0.2)
+    ap.add_argument("--sleep_idle", type=float, default=0.2,
+                    help="poll interval when inotify is unavailable")
+    ap.add_argument("--rescan_idle", type=float, default=5.0,
+                    help="safety rescan interval while waiting on inotify")
     args = ap.parse_args()
 
     ROOT = Path(args.root).resolve()
@@ -137,7 +369,7 @@ def main():
     OUT  = ROOT / "refine_outbox"
     REPT = ROOT / "reports"
 
-    for d in (WORK, OUT, REPT):
+    for d in (POOL, WORK, OUT, REPT):
         d.mkdir(parents=True, exist_ok=True)
 
     calc = GraceCalculator(
@@ -154,97 +386,107 @@ def main():
     signal.signal(signal.SIGINT, _sigterm)
     signal.signal(signal.SIGTERM, _sigterm)
 
-    while not stop["flag"]:
-        # Pick lowest-energy task from waiting_pool
-        picked = None
-        for d in list_pool_sorted_by_energy(POOL):
-            target = WORK / d.name
-            try:
-                os.rename(d, target)  # atomic claim
-                picked = target
+    counter = open_counter(ROOT, "slow_count", args.slot)
+
+    jobs = queue.Queue(maxsize=2)
+    writer = threading.Thread(target=output_writer, args=(jobs,))
+    writer.start()
+
+    pool_watch = open_dir_watch(POOL)
+
+    try:
+        while not stop["flag"]:
+            if not writer.is_alive():
+                sys.stderr.write(f"[{args.worker_id}] output writer died, stopping\n")
                 break
-            except OSError:
-                continue
-        if picked is None:
-            time.sleep(args.sleep_idle)
-            continue
 
-        try:
-            atomic_increment_counter(ROOT, "slow_count")
+            # Pick lowest-energy task from waiting_pool
+            picked = None
+            for bdir, name in iter_pool_by_energy(POOL, pool_watch):
+                target = WORK / name
+                try:
+                    os.rename(os.path.join(bdir, name), target)  # atomic claim
+                    picked = target
+                    break
+                except OSError:
+                    continue
+            if picked is None:
+                if pool_watch is None:
+                    time.sleep(args.sleep_idle)
+                    continue
+                # sleep until a fast worker publishes into the pool
+                deadline = time.monotonic() + args.rescan_idle
+                while not stop["flag"] and time.monotonic() < deadline:
+                    if wait_for_event(pool_watch, WAIT_SLICE_S):
+                        break
+                continue
 
             meta_in = {}
-            meta_file = picked / "meta.json"
+            handed_off = False
             try:
-                meta_in = json.loads(meta_file.read_text())
-            except Exception:
-                meta_in = {}
-
-            struct = Structure.from_file(str(picked / "POSCAR"))
-
-            t0 = time.time()
-            calc.fmax = args.fmax_refine
-            calc.max_steps = args.max_steps_refine
-            res = calc.relax(struct)
-            E_final = float(res["energy"])
-            struct_final = res["final_structure"]
-            elapsed = round(time.time() - t0, 3)
-
-            task_id = meta_in.get("task_id", picked.name)
-            tmpd  = OUT / (".tmp_" + task_id)
-            final = OUT / task_id
-            tmpd.mkdir(parents=True, exist_ok=True)
-
-            atomic_write_poscar(struct_final, tmpd / "CONTCAR")
-            atomic_write_text(tmpd / "energy", f"{E_final:.12f}\n")
-            meta_out = {
-                **meta_in,
-                "task_id": task_id,
-                "energy_final": E_final,
-                "fmax_refine": args.fmax_refine,
-                "max_steps_refine": args.max_steps_refine,
-                "elapsed_refine_s": elapsed,
-                "worker_id": args.worker_id,
-                "stamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-            }
-            atomic_write_json(tmpd / "meta.json", meta_out)
-
-            # pass-through SAVE if present
-            save_in = picked / "SAVE"
-            if save_in.exists():
-                atomic_copy(save_in, tmpd / "SAVE")
-
-            os.rename(tmpd, final)
-
-            # lightweight report for C++ master
-            report = {
-                "task_id": task_id,
-                "energy_final": E_final,
-                "energy_screen": meta_in.get("energy_screen"),
-                "worker_id": args.worker_id,
-                "stamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-            }
-            atomic_write_json(REPT / f"{task_id}.json", report)
+                bump_counter(counter)
 
-        except Exception as e:
-            task_id = meta_in.get("task_id", picked.name) if "meta_in" in locals() else picked.name
-            atomic_write_json(REPT / f"{task_id}.json", {
-                "task_id": task_id,
-                "status": "error",
-                "error": str(e),
-                "worker_id": args.worker_id,
-                "stamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-            })
-        finally:
-            # cleanup working dir
-            try:
-                for p in picked.iterdir():
-                    try:
-                        p.unlink()
-                    except IsADirectoryError:
-                        pass
-                picked.rmdir()
-            except Exception:
-                pass
+                meta_file = picked / "meta.json"
+                try:
+                    meta_in = json.loads(meta_file.read_text())
+                except Exception:
+                    meta_in = {}
+
+                struct = load_task_structure(picked)
+
+                t0 = time.time()
+                res = calc.relax(struct)
+                E_final = float(res["energy"])
+                struct_final = res["final_structure"]
+                elapsed = round(time.time() - t0, 3)
+
+                task_id = meta_in.get("task_id", picked.name)
+                meta_out = {
+                    **meta_in,
+                    "task_id": task_id,
+                    "energy_final": E_final,
+                    "fmax_refine": args.fmax_refine,
+                    "max_steps_refine": args.max_steps_refine,
+                    "elapsed_refine_s": elapsed,
+                    "worker_id": args.worker_id,
+                    "stamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+                }
+                report = {
+                    "task_id": task_id,
+                    "energy_final": E_final,
+                    "energy_screen": meta_in.get("energy_screen"),
+                    "worker_id": args.worker_id,
+                    "stamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+                }
+                # hand the output step to the writer thread (blocks if it is 2 behind)
+                hand_off(jobs, writer, {
+                    "picked": picked,
+                    "task_id": task_id,
+                    "out": OUT,
+                    "rept": REPT,
+                    "struct_final": struct_final,
+                    "energy_final": E_final,
+                    "meta_out": meta_out,
+                    "report": report,
+                })
+                handed_off = True
+
+            except Exception as e:
+                task_id = meta_in.get("task_id", picked.name)
+                write_error_report(REPT, task_id, args.worker_id, e)
+            finally:
+                # cleanup working dir (the writer does it for handed-off jobs)
+                if not handed_off:
+                    shutil.rmtree(picked, ignore_errors=True)
+    finally:
+        # flush pending outputs before exiting, even if the loop raised:
+        # the writer is not a daemon and would otherwise keep us alive
+        try:
+            hand_off(jobs, writer, None)
+        except RuntimeError:
+            pass  # writer already gone
+        writer.join()
+        flush_counter(counter)
 
     sys.stderr.write(f"[{args.worker_id}] bye\n")
 